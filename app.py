@@ -1,48 +1,176 @@
 import streamlit as st
 import numpy as np
-from PIL import Image
+import pandas as pd
+from PIL import Image, ImageSequence
 import cv2
+import hashlib
 import tempfile
 import os
+import shutil
+import ffmpeg
 import plotly.graph_objects as go
-from movement_detector import detect_significant_movement
+from movement_detector import classify_movement, compute_transformations
 
-def load_frames_from_video(uploaded_video):
+MAX_FRAMES_TO_SHOW = 6
+THUMBNAIL_WIDTH = 480
+FEATURE_CACHE_DIR = os.path.join(tempfile.gettempdir(), "movement_features")
+FEATURE_CACHE_MAX_BYTES = 512 * 1024 * 1024
 
-    tfile = tempfile.NamedTemporaryFile(delete=False, suffix=".mp4")
-    tfile.write(uploaded_video.read())
-    tfile.close()
+def upload_digest(uploaded_file):
 
-    cap = cv2.VideoCapture(tfile.name)
-    frames = []
-    while True:
+    # Hash the upload in chunks so it never needs a second full bytes copy
+    digest = hashlib.blake2b(digest_size=16)
+    uploaded_file.seek(0)
+    for chunk in iter(lambda: uploaded_file.read(1 << 20), b''):
+        digest.update(chunk)
+    uploaded_file.seek(0)
+    return digest.hexdigest()
+
+def save_uploaded_video(uploaded_video):
+
+    uploaded_video.seek(0)
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as tfile:
+        shutil.copyfileobj(uploaded_video, tfile, length=1 << 20)
+    return tfile.name
+
+def load_frames_from_video(video_path):
+
+    try:
+        probe = ffmpeg.probe(video_path)
+    except ffmpeg.Error:
+        return
+    stream = next((s for s in probe['streams'] if s['codec_type'] == 'video'), None)
+    if stream is None:
+        return
+    width, height = int(stream['width']), int(stream['height'])
+    frame_size = width * height
+
+    # ORB only needs luma, so let ffmpeg emit 8-bit gray and skip BGR/RGB conversions.
+    # Autorotation is disabled so frames keep the coded size reported by ffprobe, and
+    # passthrough timing emits exactly one frame per decoded frame, so indices match
+    # cv2.VideoCapture seeking even for variable-frame-rate uploads.
+    process = (
+        ffmpeg
+        .input(video_path, noautorotate=None)
+        .output('pipe:', format='rawvideo', pix_fmt='gray', vsync='passthrough')
+        .global_args('-loglevel', 'error')
+        .run_async(pipe_stdout=True)
+    )
+    try:
+        while True:
+            buf = process.stdout.read(frame_size)
+            if len(buf) < frame_size:
+                break
+            yield np.frombuffer(buf, np.uint8).reshape(height, width)
+    finally:
+        # Kill before closing the pipe so an early stop doesn't make ffmpeg
+        # report a broken pipe
+        if process.poll() is None:
+            process.kill()
+        process.stdout.close()
+        process.wait()
+
+def load_rgb_frames(video_path, frame_indices):
+
+    cap = cv2.VideoCapture(video_path)
+    frames = {}
+    for frame_idx in sorted(frame_indices):
+        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
         ret, frame_bgr = cap.read()
-        if not ret:
-            break
-        frame_rgb = cv2.cvtColor(frame_bgr, cv2.COLOR_BGR2RGB)
-        frames.append(frame_rgb)
+        if ret:
+            frames[frame_idx] = frame_bgr[:, :, ::-1]
     cap.release()
-    
-    os.unlink(tfile.name)
     return frames
 
 def load_frames_from_gif(uploaded_gif):
-    frames = []
     gif = Image.open(uploaded_gif)
-    
+    return [np.asarray(frame.convert('RGB')) for frame in ImageSequence.Iterator(gif)]
+
+def iter_uploaded_frames(uploaded_file, file_name):
+
+    if file_name.lower().endswith('.gif'):
+        uploaded_file.seek(0)
+        yield from load_frames_from_gif(uploaded_file)
+        return
+
+    video_path = save_uploaded_video(uploaded_file)
     try:
-        while True:
-            frame_rgb = gif.convert('RGB')
-            frame_np = np.array(frame_rgb)
-            frames.append(frame_np)
-            gif.seek(gif.tell() + 1)
-    except EOFError:
+        yield from load_frames_from_video(video_path)
+    finally:
+        os.unlink(video_path)
+
+def prune_feature_cache():
+
+    # Drop least recently used feature files until the directory fits the cap
+    entries = []
+    for name in os.listdir(FEATURE_CACHE_DIR):
+        if name.endswith('.npz'):
+            path = os.path.join(FEATURE_CACHE_DIR, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= FEATURE_CACHE_MAX_BYTES:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+@st.cache_data(show_spinner=False)
+def compute_transforms(digest, file_name, min_features, ransac_threshold, _uploaded_file):
+
+    # ORB features are persisted per upload so they survive app restarts and
+    # are shared across sessions
+    os.makedirs(FEATURE_CACHE_DIR, exist_ok=True)
+    feature_cache = os.path.join(FEATURE_CACHE_DIR, f"{digest}.npz")
+
+    try:
+        os.utime(feature_cache)
+    except FileNotFoundError:
         pass
-    
-    return frames
 
+    # Frames are decoded lazily, so a cache hit never touches the video
+    frames = iter_uploaded_frames(_uploaded_file, file_name)
+    results = compute_transformations(frames, min_features, ransac_threshold, feature_cache=feature_cache)
+    prune_feature_cache()
+    return results
+
+def encode_thumbnail(frame_rgb):
+
+    scale = THUMBNAIL_WIDTH / frame_rgb.shape[1]
+    if scale < 1.0:
+        frame_rgb = cv2.resize(frame_rgb, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    # Channel swaps are strided views; cv2 copies them only if it needs to
+    ok, buf = cv2.imencode('.jpg', frame_rgb[:, :, ::-1], [cv2.IMWRITE_JPEG_QUALITY, 75])
+    return buf.tobytes() if ok else None
+
+@st.cache_data(show_spinner=False)
+def load_movement_images(digest, file_name, frame_indices, _uploaded_file):
+
+    if file_name.lower().endswith('.gif'):
+        _uploaded_file.seek(0)
+        frames = load_frames_from_gif(_uploaded_file)
+        images = {i: frames[i] for i in frame_indices if i < len(frames)}
+    else:
+        video_path = save_uploaded_video(_uploaded_file)
+        try:
+            images = load_rgb_frames(video_path, frame_indices)
+        finally:
+            os.unlink(video_path)
+
+    # Ship small JPEGs to the browser instead of full-resolution arrays
+    thumbnails = {i: encode_thumbnail(frame) for i, frame in images.items()}
+    return {i: jpeg for i, jpeg in thumbnails.items() if jpeg is not None}
+
+@st.cache_data(show_spinner=False)
 def create_movement_chart(movement_scores, movement_frames):
 
+    movement_scores = np.asarray(movement_scores)
     fig = go.Figure()
     
 
@@ -56,7 +184,12 @@ def create_movement_chart(movement_scores, movement_frames):
     
 
     if movement_frames:
-        movement_scores_highlight = [movement_scores[i] if i < len(movement_scores) else 0 for i in movement_frames]
+        frame_indices = np.asarray(movement_frames)
+        movement_scores_highlight = np.where(
+            frame_indices < len(movement_scores),
+            np.take(movement_scores, np.clip(frame_indices, 0, len(movement_scores) - 1)),
+            0
+        )
         fig.add_trace(go.Scatter(
             x=movement_frames,
             y=movement_scores_highlight,
@@ -71,7 +204,7 @@ def create_movement_chart(movement_scores, movement_frames):
         xaxis_title='Frame Index',
         yaxis_title='Movement Score',
         hovermode='x unified',
-        height=400
+        height=500
     )
     
     return fig
@@ -97,27 +230,26 @@ def main():
             accept_multiple_files=False,
             help="Upload a video (MP4, MOV, AVI, MKV) or an animated GIF file"
         )
-        frames = []
+        results = None
         if uploaded_file is not None:
-            with st.spinner("Processing file..."):
-                if uploaded_file.name.lower().endswith('.gif'):
-                    frames = load_frames_from_gif(uploaded_file)
-                else:
-                    frames = load_frames_from_video(uploaded_file)
-
-        st.header("Results")
-        if frames:
-            st.success(f"Loaded {len(frames)} frames")
+            # The cached functions are keyed on the digest; the leading underscore
+            # keeps st.cache_data from hashing the upload itself
+            digest = upload_digest(uploaded_file)
             with st.spinner("Analyzing movement..."):
-                results = detect_significant_movement(
-                    frames, 
-                    threshold=50,
-                    min_features=10,
-                    ransac_threshold=3.0
+                results = compute_transforms(
+                    digest,
+                    uploaded_file.name,
+                    min_features=8,
+                    ransac_threshold=3.0,
+                    _uploaded_file=uploaded_file
                 )
-                movement_frames = results['movement_frames']
-                movement_scores = results['movement_scores']
-                transformation_data = results['transformation_data']
+
+        st.header("Results")
+        if results and results['frame_count']:
+            st.success(f"Loaded {results['frame_count']} frames")
+            transformation_data = results['transformation_data']
+            movement_scores = transformation_data['score']
+            movement_frames = classify_movement(transformation_data, threshold=50)
             if movement_frames:
                 st.warning(f"Detected movement in {len(movement_frames)} frames")
                 st.write("**Movement detected at frames:**", movement_frames)
@@ -126,38 +258,37 @@ def main():
             if len(movement_scores) > 1:
                 st.subheader("Movement Analysis Chart")
                 with st.container():
-                    chart = create_movement_chart(movement_scores, movement_frames)
-                    chart.update_layout(height=500, width=None)
+                    chart = create_movement_chart(tuple(movement_scores), tuple(movement_frames))
                     st.plotly_chart(chart, use_container_width=True)
-            if transformation_data:
+            if len(transformation_data['frame_idx']):
                 st.subheader("Detailed Analysis")
-                if transformation_data:
-                    analysis_data = []
-                    for data in transformation_data:
-                        movement_type = "Camera movement" if (data['score'] > 50 and data['inliers'] / max(data['matches'],1) > 0.5) else "Object/static"
-                        analysis_data.append({
-                            "Frame": data['frame_idx'],
-                            "Matches": data['matches'],
-                            "Inliers": data['inliers'],
-                            "Score": f"{data['score']:.2f}",
-                            "Movement Type": movement_type
-                        })
-                    st.dataframe(analysis_data, use_container_width=True)
+                scores = transformation_data['score']
+                matches = transformation_data['matches']
+                inliers = transformation_data['inliers']
+                is_camera = (scores > 50) & (inliers / np.maximum(matches, 1) > 0.5)
+                analysis_data = pd.DataFrame({
+                    "Frame": transformation_data['frame_idx'],
+                    "Matches": matches,
+                    "Inliers": inliers,
+                    "Score": np.char.mod('%.2f', scores),
+                    "Movement Type": np.where(is_camera, "Camera movement", "Object/static")
+                })
+                st.dataframe(analysis_data, use_container_width=True)
             if movement_frames:
                 st.subheader("Detected Movement Frames")
-                max_frames_to_show = 6
-                frames_to_show = movement_frames[:max_frames_to_show]
+                frames_to_show = movement_frames[:MAX_FRAMES_TO_SHOW]
+                movement_images = load_movement_images(digest, uploaded_file.name, tuple(frames_to_show), uploaded_file)
                 cols = st.columns(min(3, len(frames_to_show)))
                 for i, frame_idx in enumerate(frames_to_show):
-                    if frame_idx < len(frames):
+                    if frame_idx in movement_images:
                         with cols[i % 3]:
                             st.image(
-                                frames[frame_idx],
+                                movement_images[frame_idx],
                                 caption=f"Frame {frame_idx}",
                                 use_container_width=True
                             )
-                if len(movement_frames) > max_frames_to_show:
-                    st.info(f"Showing first {max_frames_to_show} frames. Total: {len(movement_frames)} frames with movement.")
+                if len(movement_frames) > MAX_FRAMES_TO_SHOW:
+                    st.info(f"Showing first {MAX_FRAMES_TO_SHOW} frames. Total: {len(movement_frames)} frames with movement.")
         else:
             st.info("Please upload a video or image sequence to begin analysis")
     
@@ -1,109 +1,343 @@
+import math
+import os
+import tempfile
+import threading
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 import cv2
 import numpy as np
-from typing import List, Tuple, Dict
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
-def detect_significant_movement(
-    frames: List[np.ndarray],
-    threshold: float = 50.0,
-    min_features: int = 10,
-    ransac_threshold: float = 3.0
-    
-) -> Dict[str, List]:
-    movement_frames = []
-    movement_scores = []
-    transformation_data = []
-    orb = cv2.ORB_create(nfeatures=1000)
-    prev_gray = None
-    prev_keypoints = None
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+WORKING_WIDTH = 640
+
+# Consecutive frames differ little, so a few well-spread features on a short
+# pyramid are enough to recover the global homography
+ORB_PARAMS = dict(nfeatures=300, scaleFactor=1.3, nlevels=4, edgeThreshold=15, fastThreshold=15)
+
+_TX_NORM = 1.0 / 8.0
+_ROT_NORM = 18.0 / math.pi
+_SCALE_NORM = 1.0 / 0.08
+
+def _cuda_available() -> bool:
+    try:
+        return cv2.cuda.getCudaEnabledDeviceCount() > 0
+    except (AttributeError, cv2.error):
+        return False
+
+USE_CUDA = _cuda_available()
+
+_thread_local = threading.local()
+
+def _get_orb():
+    # ORB instances are not thread-safe, so each worker keeps its own
+    orb = getattr(_thread_local, 'orb', None)
+    if orb is None:
+        if USE_CUDA:
+            orb = cv2.cuda_ORB.create(**ORB_PARAMS)
+        else:
+            orb = cv2.ORB_create(**ORB_PARAMS)
+        _thread_local.orb = orb
+    return orb
+
+def _create_matcher():
+    if USE_CUDA:
+        return cv2.cuda.DescriptorMatcher_createBFMatcher(cv2.NORM_HAMMING)
+    return cv2.BFMatcher(cv2.NORM_HAMMING)
+
+def _extract_features(frame: np.ndarray, scale: float) -> Tuple[np.ndarray, np.ndarray]:
+    if scale < 1.0:
+        frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+    orb = _get_orb()
+    if USE_CUDA:
+        # Descriptors stay on the device for the CUDA matcher; only keypoints come back
+        d_gray = cv2.cuda_GpuMat()
+        d_gray.upload(gray)
+        d_keypoints, descriptors = orb.detectAndComputeAsync(d_gray, None)
+        keypoints = orb.convert(d_keypoints)
+    else:
+        keypoints, descriptors = orb.detectAndCompute(gray, None)
+    pts_all = cv2.KeyPoint_convert(keypoints) if keypoints else np.empty((0, 2), np.float32)
+    return descriptors, pts_all
+
+def _thumbnail(frame: np.ndarray) -> np.ndarray:
+    thumb = cv2.resize(frame, (32, 32), interpolation=cv2.INTER_AREA)
+    if thumb.ndim == 3:
+        thumb = cv2.cvtColor(thumb, cv2.COLOR_RGB2GRAY)
+    return thumb.astype(np.int16)
+
+FeatureSet = Tuple[np.ndarray, np.ndarray]
+FrameFeatures = Optional[Tuple[np.ndarray, np.ndarray, Optional[FeatureSet]]]
+
+def _resolve(item) -> FrameFeatures:
+    if item is None:
+        return None
+    future, bridge = item
+    descriptors, pts_all = future.result()
+    return descriptors, pts_all, bridge.result() if bridge is not None else None
+
+def _iter_features(frames: Iterable[np.ndarray], scale: float, static_threshold: float) -> Iterator[FrameFeatures]:
+    # Keep a bounded window of frames in flight so decoding overlaps with ORB
+    # without materializing the whole video. A frame whose thumbnail barely
+    # differs from both its predecessor and the last processed frame skips ORB
+    # and yields None. The first frame after such a run also carries "bridge"
+    # features of its predecessor, so it is always matched across one frame.
+    max_workers = 1 if USE_CUDA else os.cpu_count() or 1
+    pending = deque()
+    anchor_thumb = None
+    prev_thumb = None
+    prev_frame = None
+    prev_gated = False
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        for frame in frames:
+            thumb = _thumbnail(frame)
+            gated = (
+                anchor_thumb is not None and
+                np.abs(thumb - anchor_thumb).mean() < static_threshold and
+                np.abs(thumb - prev_thumb).mean() < static_threshold
+            )
+            if gated:
+                pending.append(None)
+            else:
+                anchor_thumb = thumb
+                bridge = ex.submit(_extract_features, prev_frame, scale) if prev_gated else None
+                pending.append((ex.submit(_extract_features, frame, scale), bridge))
+            prev_thumb, prev_frame, prev_gated = thumb, frame, gated
+            if len(pending) >= 2 * max_workers:
+                yield _resolve(pending.popleft())
+        while pending:
+            yield _resolve(pending.popleft())
+
+_FEATURE_CACHE_VERSION = 2
+
+def _feature_signature(static_threshold: float) -> str:
+    # Everything that changes the extracted features; a cache written with a
+    # different signature is treated as a miss
+    return repr((_FEATURE_CACHE_VERSION, sorted(ORB_PARAMS.items()), WORKING_WIDTH, USE_CUDA, static_threshold))
+
+def _save_features(
+    path: str, scale: float, static_threshold: float,
+    features: List[FrameFeatures]
+) -> None:
+    # Each frame has two slots (its own features and the bridge features of its
+    # predecessor); variable-length arrays are concatenated and sliced back by
+    # offsets, and empty slots contribute no rows
+    pts, des = [np.empty((0, 2), np.float32)], [np.empty((0, 32), np.uint8)]
+    counts = []
+    present = np.zeros((len(features), 2), bool)
+    for i, feature in enumerate(features):
+        slots = (feature[:2], feature[2]) if feature is not None else (None, None)
+        for j, slot in enumerate(slots):
+            if slot is None:
+                counts.append(0)
+                continue
+            present[i, j] = True
+            descriptors, pts_all = slot
+            if descriptors is not None and not isinstance(descriptors, np.ndarray):
+                descriptors = descriptors.download()
+            counts.append(len(pts_all))
+            pts.append(pts_all)
+            des.append(descriptors if descriptors is not None else np.empty((0, 32), np.uint8))
+    # Several threads of one process may write the same path, so use a unique temp name
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            np.savez_compressed(
+                out,
+                scale=scale,
+                signature=np.array(_feature_signature(static_threshold)),
+                present=present,
+                offsets=np.concatenate([[0], np.cumsum(counts, dtype=np.int64)]),
+                pts=np.concatenate(pts),
+                des=np.concatenate(des)
+            )
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+def _load_slot(offsets: np.ndarray, pts: np.ndarray, des: np.ndarray, k: int) -> FeatureSet:
+    descriptors = des[offsets[k]:offsets[k + 1]]
+    if len(descriptors) == 0:
+        descriptors = None
+    elif USE_CUDA:
+        d_descriptors = cv2.cuda_GpuMat()
+        d_descriptors.upload(descriptors)
+        descriptors = d_descriptors
+    return descriptors, pts[offsets[k]:offsets[k + 1]]
+
+def _load_features(path: str, static_threshold: float) -> Optional[Tuple[float, List[FrameFeatures]]]:
+    if not os.path.exists(path):
+        return None
+    # A truncated or otherwise unreadable file counts as a miss and gets overwritten
+    try:
+        with np.load(path) as data:
+            if 'signature' not in data.files or str(data['signature']) != _feature_signature(static_threshold):
+                return None
+            scale = float(data['scale'])
+            present, offsets, pts, des = data['present'], data['offsets'], data['pts'], data['des']
+    except (zipfile.BadZipFile, KeyError, ValueError, EOFError, OSError):
+        return None
+    if present.ndim != 2 or len(offsets) != present.size + 1:
+        return None
+    features = []
+    for i, (has_own, has_bridge) in enumerate(present):
+        if not has_own:
+            features.append(None)
+            continue
+        descriptors, pts_all = _load_slot(offsets, pts, des, 2 * i)
+        bridge = _load_slot(offsets, pts, des, 2 * i + 1) if has_bridge else None
+        features.append((descriptors, pts_all, bridge))
+    return scale, features
+
+def _allocate_buffers(capacity: int) -> Dict[str, np.ndarray]:
+    # Frames without a usable homography store NaN in 'homography'
+    return {
+        'frame_idx': np.empty(capacity, np.int32),
+        'homography': np.empty((capacity, 3, 3), np.float64),
+        'matches': np.empty(capacity, np.int32),
+        'inliers': np.empty(capacity, np.int32),
+        'score': np.empty(capacity, np.float32)
+    }
+
+def _grow(arr: np.ndarray, capacity: int) -> np.ndarray:
+    grown = np.empty((capacity,) + arr.shape[1:], arr.dtype)
+    grown[:len(arr)] = arr
+    return grown
+
+def _record(
+    buffers: Dict[str, np.ndarray], n: int, idx: int,
+    H: Optional[np.ndarray], num_matches: int, num_inliers: int, score: float
+) -> None:
+    buffers['frame_idx'][n] = idx
+    buffers['homography'][n] = H if H is not None else np.nan
+    buffers['matches'][n] = num_matches
+    buffers['inliers'][n] = num_inliers
+    buffers['score'][n] = score
+
+def compute_transformations(
+    frames: Iterable[np.ndarray],
+    min_features: int = 8,
+    ransac_threshold: float = 3.0,
+    static_threshold: float = 1.5,
+    feature_cache: Optional[str] = None
+) -> Dict[str, Any]:
+    frame_count = 0
+    # Per-frame results are kept as one array per field; the frame count is not
+    # known up front when streaming, so the buffers grow by doubling
+    capacity = 256
+    buffers = _allocate_buffers(capacity)
+    n = 0
+    bf = _create_matcher()
     prev_descriptors = None
+    prev_pts_all = None
+    # When feature_cache points at a previous run's .npz, ORB is skipped and
+    # frames is never consumed
+    cached = _load_features(feature_cache, static_threshold) if feature_cache else None
+    collected = None
+    if cached is not None:
+        scale, feature_iter = cached
+    else:
+        frames = iter(frames)
+        first = next(frames, None)
+        scale = min(WORKING_WIDTH / first.shape[1], 1.0) if first is not None else 1.0
+        frames = chain([first], frames) if first is not None else frames
+        feature_iter = _iter_features(frames, scale, static_threshold)
+        if feature_cache:
+            collected = []
     
-    
-    for idx, frame in enumerate(frames):
-        gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
-        if prev_gray is not None:
-            keypoints, descriptors = orb.detectAndCompute(gray, None)
-            
-            if (prev_keypoints is not None and prev_descriptors is not None and 
-                len(keypoints) > min_features and len(prev_keypoints) > min_features):
-                bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
-                matches = bf.match(prev_descriptors, descriptors)
-                matches = sorted(matches, key=lambda x: x.distance)
+    for idx, features in enumerate(feature_iter):
+        frame_count += 1
+        if collected is not None:
+            collected.append(features)
+        if n == capacity:
+            capacity *= 2
+            buffers = {k: _grow(v, capacity) for k, v in buffers.items()}
+        if features is None:
+            # Static frame: the next processed frame brings its own bridge features
+            _record(buffers, n, idx, np.eye(3), 0, 0, 0.0)
+            n += 1
+            continue
+        descriptors, pts_all, bridge = features
+        if bridge is not None:
+            prev_descriptors, prev_pts_all = bridge
+        if idx > 0:
+            H, num_matches, num_inliers, movement_score = None, 0, 0, 100.0
+            if (prev_descriptors is not None and descriptors is not None and
+                len(pts_all) > min_features and len(prev_pts_all) > min_features):
+                knn = bf.knnMatch(prev_descriptors, descriptors, k=2)
+                matches = [p[0] for p in knn if len(p) == 2 and p[0].distance < 0.75 * p[1].distance]
+                num_matches = len(matches)
                 
-                if len(matches) >= min_features:
-                    src_pts = np.float32([prev_keypoints[m.queryIdx].pt for m in matches]).reshape(-1, 1, 2)
-                    dst_pts = np.float32([keypoints[m.trainIdx].pt for m in matches]).reshape(-1, 1, 2)
-                    H, mask = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC, ransac_threshold)
+                if num_matches >= min_features:
+                    q = np.fromiter((m.queryIdx for m in matches), dtype=np.int32, count=num_matches)
+                    t = np.fromiter((m.trainIdx for m in matches), dtype=np.int32, count=num_matches)
+                    src_pts = prev_pts_all[q].reshape(-1, 1, 2)
+                    dst_pts = pts_all[t].reshape(-1, 1, 2)
+                    # ransac_threshold is in source pixels; points are at working resolution
+                    H, mask = cv2.findHomography(src_pts, dst_pts, cv2.USAC_MAGSAC, ransac_threshold * scale, maxIters=2000, confidence=0.995)
                     
                     if H is not None:
-                        movement_score = analyze_transformation(H, len(matches), len(matches) * np.sum(mask) / len(mask))
-                        transformation_data.append({
-                            'frame_idx': idx,
-                            'homography': H,
-                            'matches': len(matches),
-                            'inliers': int(np.sum(mask)),
-                            'score': movement_score
-                        })
-                        movement_scores.append(movement_score)
-                        
-                        if movement_score > threshold:
-                            movement_frames.append(idx)
-                    
-                    else:
-                        movement_scores.append(100.0)
-                        movement_frames.append(idx)
-                        transformation_data.append({
-                            'frame_idx': idx,
-                            'homography': None,
-                            'matches': len(matches),
-                            'inliers': 0,
-                            'score': 100.0
-                        })
-                
-                else:
-                    movement_scores.append(100.0)
-                    movement_frames.append(idx)
-                    transformation_data.append({
-                        'frame_idx': idx,
-                        'homography': None,
-                        'matches': len(matches),
-                        'inliers': 0,
-                        'score': 100.0
-                    })
-            
-            else:
-                movement_scores.append(100.0)
-                movement_frames.append(idx)
-                transformation_data.append({
-                    'frame_idx': idx,
-                    'homography': None,
-                    'matches': 0,
-                    'inliers': 0,
-                    'score': 100.0
-                })
-        prev_gray = gray
-        prev_keypoints, prev_descriptors = orb.detectAndCompute(gray, None)
+                        num_inliers = int(mask.sum())
+                        movement_score = analyze_transformation(H, num_matches, num_inliers, scale)
+            _record(buffers, n, idx, H, num_matches, num_inliers, movement_score)
+            n += 1
+        prev_descriptors = descriptors
+        prev_pts_all = pts_all
+    
+    if collected is not None:
+        _save_features(feature_cache, scale, static_threshold, collected)
     
     return {
-        'movement_frames': movement_frames,
-        'movement_scores': movement_scores,
-        'transformation_data': transformation_data
+        'transformation_data': {k: v[:n] for k, v in buffers.items()},
+        'frame_count': frame_count
     }
 
-def analyze_transformation(H: np.ndarray, num_matches: int, num_inliers: int) -> float:
-    if H is None:
-        return 100.0
-    tx = H[0, 2]
-    ty = H[1, 2]
-    a = H[0, 0]
-    b = H[0, 1]
-    c = H[1, 0]
-    d = H[1, 1]
-    translation_magnitude = np.sqrt(tx**2 + ty**2)
-    rotation_angle = np.arctan2(b, a)
-    scale_factor = np.sqrt(a**2 + c**2)
-    normalized_translation = min(translation_magnitude / 8.0, 1.0)
-    normalized_rotation = min(abs(rotation_angle) / (np.pi/18), 1.0)
-    normalized_scale = min(abs(scale_factor - 1.0) / 0.08, 1.0)
+def classify_movement(transformation_data: Dict[str, np.ndarray], threshold: float = 50.0) -> List[int]:
+    # Frames where no homography could be estimated always count as movement
+    failed = np.isnan(transformation_data['homography'][:, 0, 0])
+    is_movement = failed | (transformation_data['score'] > threshold)
+    return transformation_data['frame_idx'][is_movement].tolist()
+
+def detect_significant_movement(
+    frames: Iterable[np.ndarray],
+    threshold: float = 50.0,
+    min_features: int = 8,
+    ransac_threshold: float = 3.0,
+    static_threshold: float = 1.5,
+    feature_cache: Optional[str] = None
+) -> Dict[str, Any]:
+    results = compute_transformations(frames, min_features, ransac_threshold, static_threshold, feature_cache)
+    transformation_data = results['transformation_data']
+    return {
+        'movement_frames': classify_movement(transformation_data, threshold),
+        'movement_scores': transformation_data['score'],
+        'transformation_data': transformation_data,
+        'frame_count': results['frame_count']
+    }
+
+@njit(cache=True, fastmath=True)
+def _analyze_transformation_core(
+    a: float, b: float, tx: float,
+    c: float, d: float, ty: float,
+    num_matches: int, num_inliers: int, frame_scale: float
+) -> float:
+    # H is estimated on downscaled frames; map translation back to source pixels
+    translation_magnitude = math.hypot(tx, ty) / frame_scale
+    rotation_angle = math.atan2(b, a)
+    scale_factor = math.hypot(a, c)
+    normalized_translation = min(translation_magnitude * _TX_NORM, 1.0)
+    normalized_rotation = min(abs(rotation_angle) * _ROT_NORM, 1.0)
+    normalized_scale = min(abs(scale_factor - 1.0) * _SCALE_NORM, 1.0)
     movement_score = (
         0.6 * normalized_translation * 100 +
         0.25 * normalized_rotation * 100 +
@@ -115,4 +349,11 @@ def analyze_transformation(H: np.ndarray, num_matches: int, num_inliers: int) ->
         movement_score *= 1.05
     return movement_score
 
-
+def analyze_transformation(H: np.ndarray, num_matches: int, num_inliers: int, frame_scale: float = 1.0) -> float:
+    if H is None:
+        return 100.0
+    return _analyze_transformation_core(
+        H[0, 0], H[0, 1], H[0, 2],
+        H[1, 0], H[1, 1], H[1, 2],
+        num_matches, num_inliers, frame_scale
+    )
@@ -0,0 +1,51 @@
+import os
+import sys
+
+import pytest
+
+cv2 = pytest.importorskip("cv2")
+np = pytest.importorskip("numpy")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from movement_detector import detect_significant_movement
+
+SAMPLE_VIDEO = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "sample_video", "shaking_timed_panning_output.mp4"
+)
+
+
+@pytest.fixture(scope="module")
+def base_frame():
+    cap = cv2.VideoCapture(SAMPLE_VIDEO)
+    ok, frame_bgr = cap.read()
+    cap.release()
+    if not ok:
+        pytest.skip("sample video could not be decoded")
+    return cv2.cvtColor(frame_bgr, cv2.COLOR_BGR2RGB)
+
+
+def _crop(frame, x):
+    return np.ascontiguousarray(frame[60:660, x:x + 1000])
+
+
+@pytest.mark.parametrize("static_frames", [5, 30])
+def test_jump_after_static_run_is_detected(base_frame, static_frames):
+    frames = [_crop(base_frame, 100)] * static_frames + [_crop(base_frame, 120)]
+    results = detect_significant_movement(frames)
+
+    assert results['movement_frames'] == [static_frames]
+    assert results['movement_scores'][-1] > 50
+
+
+def test_slow_pan_scores_each_frame_against_its_predecessor(base_frame):
+    frames = [_crop(base_frame, 100 + 2 * i) for i in range(40)]
+    gated = detect_significant_movement(frames)
+    ungated = detect_significant_movement(frames, static_threshold=0)
+
+    scores = gated['movement_scores']
+    processed = scores != 0
+    # The gate must actually skip frames for this check to mean anything
+    assert 0 < processed.sum() < len(scores)
+    assert gated['movement_frames'] == []
+    np.testing.assert_array_equal(scores[processed], ungated['movement_scores'][processed])